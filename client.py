@@ -5,19 +5,34 @@ This script allows you to send requests to your deployed RunPod endpoint
 """
 
 import requests
-import json
+import orjson
 import sys
 import argparse
 import os
-from typing import Dict, Any
+import pathlib
+from typing import Dict, Any, Union
 
 # Replace this with your actual RunPod endpoint URL
 RUNPOD_ENDPOINT = "https://your-endpoint-id.runpod.net/run"
 RUNPOD_API_KEY = os.getenv("RUNPOD_API_KEY", "")
 
-def send_request(payload: Dict[str, Any]) -> Dict[str, Any]:
+# Reuse one session so repeated requests keep the connection to RunPod alive
+_SESSION = requests.Session()
+
+def merge_stream_output(chunks: list) -> Dict[str, Any]:
+    """
+    Combine streamed handler chunks into a single result:
+    image chunks (kind == "image") are collected under 'images', the final chunk holds the status
+    """
+    images = [chunk for chunk in chunks if chunk.get("kind") == "image"]
+    result = dict(chunks[-1]) if chunks else {"status": "error", "message": "Empty response"}
+    result["images"] = images
+    return result
+
+def send_request(payload: Union[Dict[str, Any], bytes]) -> Dict[str, Any]:
     """
-    Send a request to the RunPod endpoint
+    Send a request to the RunPod endpoint.
+    The payload may be a dict or an already serialized JSON body.
     """
     try:
         headers = {
@@ -28,15 +43,23 @@ def send_request(payload: Dict[str, Any]) -> Dict[str, Any]:
         if RUNPOD_API_KEY:
             headers["Authorization"] = f"Bearer {RUNPOD_API_KEY}"
         
-        response = requests.post(
+        if not isinstance(payload, bytes):
+            payload = orjson.dumps(payload)
+        
+        response = _SESSION.post(
             RUNPOD_ENDPOINT,
-            json=payload,
+            data=payload,
             headers=headers,
             timeout=300  # 5 minute timeout for model loading
         )
         response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        result = orjson.loads(response.content)
+        
+        # The handler streams its output, which RunPod aggregates into a list
+        if isinstance(result.get('output'), list):
+            return merge_stream_output(result['output'])
+        return result
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         print(f"Error sending request: {e}")
         return {"status": "error", "message": str(e)}
 
@@ -69,7 +92,10 @@ def test_comfyui_simple(prompt: str, steps: int = 20, cfg_scale: float = 7.5, wi
         
         # Display image info
         for i, image in enumerate(result.get('images', [])):
-            print(f"🖼️  Image {i+1}: {image.get('filename', 'N/A')} (size: {len(image.get('data', ''))} bytes)")
+            if 'url' in image:
+                print(f"🖼️  Image {i+1}: {image.get('filename', 'N/A')} (url: {image['url']})")
+            else:
+                print(f"🖼️  Image {i+1}: {image.get('filename', 'N/A')} (size: {len(image.get('data', ''))} bytes)")
             
     else:
         print(f"❌ Error: {result.get('message', 'Unknown error')}")
@@ -79,14 +105,14 @@ def test_comfyui_workflow(workflow_file: str):
     Test ComfyUI with a custom workflow file
     """
     try:
-        with open(workflow_file, 'r') as f:
-            workflow = json.load(f)
+        # Parse straight from bytes and serialize the request body once
+        workflow = orjson.loads(pathlib.Path(workflow_file).read_bytes())
         
-        payload = {
+        payload = orjson.dumps({
             "input": {
                 "workflow": workflow
             }
-        }
+        })
         
         print(f"🎨 Running custom ComfyUI workflow from: {workflow_file}")
         print("⏳ Processing workflow...")
@@ -104,7 +130,7 @@ def test_comfyui_workflow(workflow_file: str):
             
     except FileNotFoundError:
         print(f"❌ Workflow file not found: {workflow_file}")
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         print(f"❌ Invalid JSON in workflow file: {workflow_file}")
 
 def test_text_processing(text: str):
@@ -1,14 +1,26 @@
 import runpod
-import json
+import asyncio
+import orjson
 import base64
+import copy
 import io
 import os
 import logging
+import random
 import requests
+import string
+import threading
 import time
 import uuid
-from typing import Dict, Any, Optional
+import boto3
+import websocket
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+from typing import Dict, Any, Iterator, Optional, Tuple
 from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -18,6 +30,80 @@ logger = logging.getLogger(__name__)
 
 # ComfyUI configuration
 COMFYUI_SERVER_URL = os.getenv("COMFYUI_SERVER_URL", "http://127.0.0.1:8188")
+COMFYUI_WS_URL = COMFYUI_SERVER_URL.replace("http", "ws", 1)
+_VIEW_URL = f"{COMFYUI_SERVER_URL}/view"
+
+# Number of RunPod jobs this worker processes at the same time
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "4"))
+
+# Worker threads that advance the blocking handler generators
+_HANDLER_EXECUTOR = ThreadPoolExecutor(thread_name_prefix="handler")
+
+# Dynamic batching of identical simple prompts (BATCH_MAX_SIZE=1 disables it).
+# A batch can never hold more jobs than run at once, so cap it at MAX_CONCURRENCY
+# to let a full batch start without waiting.
+BATCH_MAX_SIZE = min(int(os.getenv("BATCH_MAX_SIZE", "8")), MAX_CONCURRENCY)
+BATCH_MAX_WAIT_MS = int(os.getenv("BATCH_MAX_WAIT_MS", "50"))
+_jobs_in_flight = 0
+_batch_lock = threading.Lock()
+_open_batches: Dict[tuple, Dict[str, Any]] = {}
+
+# Seconds a successful /system_stats probe is trusted before probing again
+HEALTH_CHECK_TTL = float(os.getenv("HEALTH_CHECK_TTL", "5"))
+_health = {"ts": 0.0, "ok": False}
+
+# Characters allowed in base64 image input
+_B64_ALPHABET = frozenset(string.ascii_letters + string.digits + '+/=')
+
+# Optional S3/R2 storage; when a bucket is set images are returned as presigned URLs
+S3_BUCKET = os.getenv("S3_BUCKET", "")
+S3_URL_EXPIRY = int(os.getenv("S3_URL_EXPIRY", "3600"))
+_S3 = boto3.client("s3", endpoint_url=os.getenv("S3_ENDPOINT_URL") or None) if S3_BUCKET else None
+
+# Shared HTTP session so calls to ComfyUI reuse pooled keep-alive connections
+_SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=2,
+    pool_maxsize=16,
+    # Transient ComfyUI errors are retried with exponential backoff inside the adapter.
+    # POST /prompt is not idempotent, so only GETs are retried after the request was
+    # sent, and read timeouts are not retried so callers' timeouts still hold.
+    max_retries=Retry(
+        total=5,
+        read=0,
+        backoff_factor=0.3,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=["GET"],
+        respect_retry_after_header=True
+    )
+)
+_SESSION.mount("http://", _adapter)
+_SESSION.mount("https://", _adapter)
+_SESSION.headers.update({"Connection": "keep-alive"})
+
+def _json(response: requests.Response) -> Any:
+    """Parse a JSON response body straight from bytes"""
+    return orjson.loads(response.content)
+
+def check_comfyui_health() -> Optional[str]:
+    """Probe ComfyUI's /system_stats and return an error message if it is unreachable"""
+    if _health["ok"] and time.monotonic() - _health["ts"] < HEALTH_CHECK_TTL:
+        return None
+    
+    # Probe without the session's retries so a down server is reported immediately
+    try:
+        response = requests.get(f"{COMFYUI_SERVER_URL}/system_stats", timeout=10)
+        if response.status_code != 200:
+            _health["ok"] = False
+            return "ComfyUI server is not accessible"
+    except requests.exceptions.RequestException:
+        _health["ok"] = False
+        return "Cannot connect to ComfyUI server"
+    
+    # Only successes are cached so a recovering server is picked up immediately
+    _health["ok"] = True
+    _health["ts"] = time.monotonic()
+    return None
 
 def validate_input(input_data: Dict[str, Any]) -> Optional[str]:
     """Validate input data and return error message if invalid"""
@@ -63,261 +149,530 @@ def validate_input(input_data: Dict[str, Any]) -> Optional[str]:
         image_data = input_data['init_image']
         if not isinstance(image_data, str):
             return "Image data must be base64 encoded string"
-        try:
-            if len(image_data) > 20 * 1024 * 1024:  # 20MB limit
-                return "Image too large (max 20MB)"
-            base64.b64decode(image_data[:100])  # Test decode first 100 chars
-        except Exception:
+        if len(image_data) > 20 * 1024 * 1024:  # 20MB limit
+            return "Image too large (max 20MB)"
+        if not _B64_ALPHABET.issuperset(image_data[:256]):  # Check first 256 chars
             return "Invalid base64 image data"
     
     return None
 
-def queue_prompt(workflow: Dict[str, Any]) -> str:
+def queue_prompt(workflow: Dict[str, Any], client_id: Optional[str] = None) -> str:
     """Queue a prompt to ComfyUI and return the prompt ID"""
+    payload = {"prompt": workflow}
+    if client_id:
+        # Lets ComfyUI route execution events to our websocket
+        payload["client_id"] = client_id
     try:
-        response = requests.post(
+        response = _SESSION.post(
             f"{COMFYUI_SERVER_URL}/prompt",
-            json={"prompt": workflow},
+            data=orjson.dumps(payload),
+            headers={"Content-Type": "application/json"},
             timeout=30
         )
         response.raise_for_status()
-        result = response.json()
+        result = _json(response)
         return result['prompt_id']
     except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to queue prompt: {e}")
+        logger.error("Failed to queue prompt: %s", e)
         raise
 
 def get_prompt_status(prompt_id: str) -> Dict[str, Any]:
     """Get the status of a queued prompt"""
     try:
-        response = requests.get(
+        response = _SESSION.get(
             f"{COMFYUI_SERVER_URL}/history/{prompt_id}",
             timeout=30
         )
         response.raise_for_status()
-        return response.json()
+        return _json(response)
     except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to get prompt status: {e}")
+        logger.error("Failed to get prompt status: %s", e)
         raise
 
+def open_websocket(client_id: str) -> Optional[websocket.WebSocket]:
+    """Open a ComfyUI event websocket, returning None if it is unavailable"""
+    try:
+        return websocket.create_connection(
+            f"{COMFYUI_WS_URL}/ws?clientId={client_id}",
+            timeout=10
+        )
+    except Exception as e:
+        logger.warning("Websocket unavailable, falling back to polling: %s", e)
+        return None
+
+def wait_for_execution(ws: websocket.WebSocket, prompt_id: str, timeout: int = 300) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Yield (node_id, output) from ComfyUI websocket events until the prompt finishes executing"""
+    deadline = time.monotonic() + timeout
+    
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Prompt {prompt_id} timed out after {timeout} seconds")
+        
+        ws.settimeout(remaining)
+        try:
+            frame = ws.recv()
+        except websocket.WebSocketTimeoutException:
+            raise TimeoutError(f"Prompt {prompt_id} timed out after {timeout} seconds")
+        
+        # Binary frames carry latent previews, which we don't need
+        if not isinstance(frame, str):
+            continue
+        
+        message = orjson.loads(frame)
+        data = message.get('data', {})
+        if data.get('prompt_id') != prompt_id:
+            continue
+        
+        if message.get('type') == 'execution_error':
+            raise Exception(f"Prompt execution failed: {data.get('exception_message', 'unknown error')}")
+        
+        # Output nodes report their results as soon as they finish
+        if message.get('type') == 'executed' and data.get('output'):
+            yield data['node'], data['output']
+        
+        # A null node in an 'executing' event marks the end of the prompt
+        if message.get('type') == 'executing' and data.get('node') is None:
+            return
+
 def wait_for_completion(prompt_id: str, timeout: int = 300) -> Dict[str, Any]:
     """Wait for prompt completion with timeout"""
     start_time = time.time()
+    attempt = 0
     
     while time.time() - start_time < timeout:
         try:
             status = get_prompt_status(prompt_id)
             if prompt_id in status:
-                # Prompt completed
+                # Prompt completed; no need to look at the queue
                 return status[prompt_id]
             
-            # Check if prompt is still running
-            response = requests.get(f"{COMFYUI_SERVER_URL}/queue", timeout=30)
-            queue_data = response.json()
+            # Only on a history miss, check if prompt is still running
+            response = _SESSION.get(f"{COMFYUI_SERVER_URL}/queue", timeout=30)
+            response.raise_for_status()
+            queue_data = _json(response)
             
             # Check if our prompt is still in the queue
             prompt_in_queue = any(
-                item[1] == prompt_id 
-                for item in queue_data.get('queue_running', []) + queue_data.get('queue_pending', [])
+                item[1] == prompt_id
+                for item in chain(queue_data.get('queue_running', ()), queue_data.get('queue_pending', ()))
             )
             
-            if not prompt_in_queue and prompt_id not in status:
+            if not prompt_in_queue:
                 raise Exception("Prompt not found in queue or history")
-                
-            time.sleep(1)  # Wait before checking again
             
-        except requests.exceptions.RequestException as e:
-            logger.warning(f"Error checking prompt status: {e}")
-            time.sleep(2)
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+            # Retries with backoff already happened in the session adapter;
+            # truncated or non-JSON bodies are likewise transient, so poll again
+            logger.warning("Error checking prompt status: %s", e)
+        
+        # Poll quickly at first, then back off towards 4s since most prompts run longer
+        time.sleep(min(4.0, 0.5 * (1.5 ** attempt)))
+        attempt += 1
     
     raise TimeoutError(f"Prompt {prompt_id} timed out after {timeout} seconds")
 
-def create_simple_workflow(input_data: Dict[str, Any]) -> Dict[str, Any]:
-    """Create a simple text-to-image workflow for ComfyUI"""
-    prompt = input_data['prompt']
-    negative_prompt = input_data.get('negative_prompt', '')
-    steps = input_data.get('steps', 20)
-    cfg_scale = input_data.get('cfg_scale', 7.5)
-    width = input_data.get('width', 512)
-    height = input_data.get('height', 512)
-    sampler_name = input_data.get('sampler_name', 'euler')
-    scheduler = input_data.get('scheduler', 'normal')
+def iter_outputs(prompt_id: str, timeout: int = 300, ws: Optional[websocket.WebSocket] = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Yield (node_id, output) for each output node as soon as it is available.
+    With a websocket, outputs stream as nodes finish; otherwise they come from
+    history once polling sees the prompt complete. Closes the websocket when done.
+    """
+    seen = set()
+    try:
+        if ws is not None:
+            for node_id, node_output in wait_for_execution(ws, prompt_id, timeout):
+                seen.add(node_id)
+                yield node_id, node_output
+            
+            status = get_prompt_status(prompt_id)
+            if prompt_id not in status:
+                raise Exception("Prompt finished but was not found in history")
+            result = status[prompt_id]
+        else:
+            result = wait_for_completion(prompt_id, timeout)
+    finally:
+        if ws is not None:
+            ws.close()
     
-    # This is a simplified workflow structure
-    # In practice, you'd want to use a proper ComfyUI workflow JSON
-    workflow = {
-        "3": {
-            "class_type": "KSampler",
-            "inputs": {
-                "seed": input_data.get('seed', int.from_bytes(os.urandom(4), 'big')),
-                "steps": steps,
-                "cfg": cfg_scale,
-                "sampler_name": sampler_name,
-                "scheduler": scheduler,
-                "denoise": 1.0,
-                "model": ["4", 0],
-                "positive": ["6", 0],
-                "negative": ["7", 0],
-                "latent_image": ["5", 0]
-            }
-        },
-        "4": {
-            "class_type": "CheckpointLoaderSimple",
-            "inputs": {
-                "ckpt_name": input_data.get('model_name', 'v1-5-pruned-emaonly.ckpt')
-            }
-        },
-        "5": {
-            "class_type": "EmptyLatentImage",
-            "inputs": {
-                "width": width,
-                "height": height,
-                "batch_size": 1
-            }
-        },
-        "6": {
-            "class_type": "CLIPTextEncode",
-            "inputs": {
-                "text": prompt,
-                "clip": ["4", 1]
-            }
-        },
-        "7": {
-            "class_type": "CLIPTextEncode",
-            "inputs": {
-                "text": negative_prompt,
-                "clip": ["4", 1]
-            }
-        },
-        "8": {
-            "class_type": "VAEDecode",
-            "inputs": {
-                "samples": ["3", 0],
-                "vae": ["4", 2]
-            }
-        },
-        "9": {
-            "class_type": "SaveImage",
-            "inputs": {
-                "filename_prefix": "ComfyUI",
-                "images": ["8", 0]
-            }
+    # History also covers outputs whose events we did not see, e.g. cached nodes
+    for node_id, node_output in result.get('outputs', {}).items():
+        if node_id not in seen:
+            yield node_id, node_output
+
+# Static text-to-image workflow; create_simple_workflow copies it and patches in request values.
+# This is a simplified workflow structure
+# In practice, you'd want to use a proper ComfyUI workflow JSON
+_BASE_WORKFLOW = {
+    "3": {
+        "class_type": "KSampler",
+        "inputs": {
+            "seed": 0,
+            "steps": 20,
+            "cfg": 7.5,
+            "sampler_name": "euler",
+            "scheduler": "normal",
+            "denoise": 1.0,
+            "model": ["4", 0],
+            "positive": ["6", 0],
+            "negative": ["7", 0],
+            "latent_image": ["5", 0]
+        }
+    },
+    "4": {
+        "class_type": "CheckpointLoaderSimple",
+        "inputs": {
+            "ckpt_name": "v1-5-pruned-emaonly.ckpt"
+        }
+    },
+    "5": {
+        "class_type": "EmptyLatentImage",
+        "inputs": {
+            "width": 512,
+            "height": 512,
+            "batch_size": 1
+        }
+    },
+    "6": {
+        "class_type": "CLIPTextEncode",
+        "inputs": {
+            "text": "",
+            "clip": ["4", 1]
+        }
+    },
+    "7": {
+        "class_type": "CLIPTextEncode",
+        "inputs": {
+            "text": "",
+            "clip": ["4", 1]
+        }
+    },
+    "8": {
+        "class_type": "VAEDecode",
+        "inputs": {
+            "samples": ["3", 0],
+            "vae": ["4", 2]
+        }
+    },
+    "9": {
+        "class_type": "SaveImage",
+        "inputs": {
+            "filename_prefix": "ComfyUI",
+            "images": ["8", 0]
         }
     }
+}
+
+def create_simple_workflow(input_data: Dict[str, Any], batch_size: int = 1) -> Dict[str, Any]:
+    """Create a simple text-to-image workflow for ComfyUI"""
+    seed = input_data.get('seed')
+    if seed is None:
+        # Seeds don't need cryptographic randomness
+        seed = random.getrandbits(32)
+    
+    workflow = copy.deepcopy(_BASE_WORKFLOW)
+    workflow["3"]["inputs"].update(
+        seed=seed,
+        steps=input_data.get('steps', 20),
+        cfg=input_data.get('cfg_scale', 7.5),
+        sampler_name=input_data.get('sampler_name', 'euler'),
+        scheduler=input_data.get('scheduler', 'normal')
+    )
+    workflow["4"]["inputs"]["ckpt_name"] = input_data.get('model_name', 'v1-5-pruned-emaonly.ckpt')
+    workflow["5"]["inputs"].update(
+        width=input_data.get('width', 512),
+        height=input_data.get('height', 512),
+        batch_size=batch_size
+    )
+    workflow["6"]["inputs"]["text"] = input_data['prompt']
+    workflow["7"]["inputs"]["text"] = input_data.get('negative_prompt', '')
     
     return workflow
 
-def extract_images_from_output(outputs: Dict[str, Any]) -> list:
+def run_workflow(workflow: Dict[str, Any], request_id: str) -> Tuple[str, Iterator[Tuple[str, Dict[str, Any]]]]:
+    """Queue a workflow, returning the prompt ID and an iterator over its output nodes"""
+    # Subscribe to execution events before queueing so none are missed
+    client_id = str(uuid.uuid4())
+    ws = open_websocket(client_id)
+    try:
+        prompt_id = queue_prompt(workflow, client_id)
+    except Exception:
+        if ws is not None:
+            ws.close()
+        raise
+    
+    logger.info("Request %s - Queued prompt with ID: %s", request_id, prompt_id)
+    return prompt_id, iter_outputs(prompt_id, timeout=300, ws=ws)
+
+def batch_key(input_data: Dict[str, Any]) -> Optional[tuple]:
+    """
+    Return the key a simple prompt request can be batched under, or None.
+    A batch shares one KSampler, so only requests with identical generation
+    parameters and no fixed seed can be merged.
+    """
+    if BATCH_MAX_SIZE <= 1 or 'workflow' in input_data or input_data.get('seed') is not None:
+        return None
+    key = (
+        input_data['prompt'],
+        input_data.get('negative_prompt', ''),
+        input_data.get('model_name', 'v1-5-pruned-emaonly.ckpt'),
+        input_data.get('steps', 20),
+        input_data.get('cfg_scale', 7.5),
+        input_data.get('sampler_name', 'euler'),
+        input_data.get('scheduler', 'normal'),
+        input_data.get('width', 512),
+        input_data.get('height', 512)
+    )
+    # Not every field is type-checked by validate_input; leave odd values
+    # (lists, dicts, ...) unbatched so ComfyUI reports them as before
+    if not all(isinstance(value, (str, int, float)) for value in key):
+        return None
+    return key
+
+def run_batched(key: tuple, input_data: Dict[str, Any], request_id: str) -> Tuple[str, Dict[str, Any], int, int]:
+    """
+    Run a simple workflow together with concurrent requests sharing the same key.
+    The first request to arrive waits up to BATCH_MAX_WAIT_MS for others, then
+    queues one prompt with batch_size set to the number of members. Returns the
+    prompt ID, its outputs, this request's index and the batch size.
+    """
+    future = Future()
+    with _batch_lock:
+        batch = _open_batches.get(key)
+        leader = batch is None
+        if leader:
+            batch = {"members": [], "full": threading.Event()}
+            _open_batches[key] = batch
+        batch["members"].append(future)
+        if len(batch["members"]) >= BATCH_MAX_SIZE:
+            del _open_batches[key]
+            batch["full"].set()
+    
+    if leader:
+        # Nobody else can join when this is the only job running
+        if _jobs_in_flight > 1:
+            batch["full"].wait(BATCH_MAX_WAIT_MS / 1000)
+        with _batch_lock:
+            if _open_batches.get(key) is batch:
+                del _open_batches[key]
+        
+        members = batch["members"]
+        try:
+            prompt_id, node_outputs = run_workflow(create_simple_workflow(input_data, batch_size=len(members)), request_id)
+            outputs = dict(node_outputs)
+        except Exception as e:
+            for member in members:
+                member.set_exception(e)
+        else:
+            for index, member in enumerate(members):
+                member.set_result((prompt_id, outputs, index, len(members)))
+    
+    return future.result()
+
+def split_batch_outputs(outputs: Dict[str, Any], index: int, batch_size: int) -> Dict[str, Any]:
+    """Select one batch member's images from each output node"""
+    return {
+        node_id: {**node_output, 'images': node_output.get('images', [])[index::batch_size]}
+        for node_id, node_output in outputs.items()
+    }
+
+def fetch_image(image_data: Dict[str, Any], upload_prefix: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Download a single output image from ComfyUI, returning None on failure.
+    With an upload_prefix the image is streamed to S3 and returned as a URL,
+    otherwise it is returned inline as base64.
+    """
+    try:
+        # The metadata doubles as /view query params; requests URL-encodes them
+        # so filenames with spaces or unicode are fetched correctly
+        image = {
+            "filename": image_data['filename'],
+            "subfolder": image_data.get('subfolder', ''),
+            "type": image_data.get('type', 'output')
+        }
+        
+        if upload_prefix is not None:
+            # Same-named files from different SaveImage prefixes must not share a key
+            key = upload_prefix + "/".join(
+                part for part in (image["type"], image["subfolder"], image["filename"]) if part
+            )
+            with _SESSION.get(_VIEW_URL, params=image, timeout=30, stream=True) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                _S3.upload_fileobj(
+                    response.raw,
+                    S3_BUCKET,
+                    key,
+                    ExtraArgs={"ContentType": response.headers.get("Content-Type", "image/png")}
+                )
+            image["url"] = _S3.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': S3_BUCKET, 'Key': key},
+                ExpiresIn=S3_URL_EXPIRY
+            )
+            return image
+        
+        # Accumulate raw bytes in one buffer and base64 encode once at the end
+        buffer = bytearray()
+        with _SESSION.get(_VIEW_URL, params=image, timeout=30, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=57344):
+                buffer += chunk
+        
+        image["data"] = base64.b64encode(buffer).decode('ascii')
+        return image
+    except Exception as e:
+        logger.error("Failed to extract image: %s", e)
+        return None
+
+def extract_images_from_output(outputs: Dict[str, Any], upload_prefix: Optional[str] = None) -> list:
     """Extract images from ComfyUI output"""
-    images = []
+    tasks = [
+        image_data
+        for node_output in outputs.values()
+        for image_data in node_output.get('images', [])
+    ]
+    if not tasks:
+        return []
     
-    for node_id, node_output in outputs.items():
-        if 'images' in node_output:
-            for image_data in node_output['images']:
-                # Download and process the image
-                try:
-                    image_url = f"{COMFYUI_SERVER_URL}/view?filename={image_data['filename']}&subfolder={image_data.get('subfolder', '')}&type={image_data.get('type', 'output')}"
-                    response = requests.get(image_url, timeout=30)
-                    response.raise_for_status()
-                    
-                    # Convert to base64
-                    image_b64 = base64.b64encode(response.content).decode()
-                    images.append({
-                        "filename": image_data['filename'],
-                        "subfolder": image_data.get('subfolder', ''),
-                        "type": image_data.get('type', 'output'),
-                        "data": image_b64
-                    })
-                except Exception as e:
-                    logger.error(f"Failed to extract image: {e}")
+    # Download concurrently; results keep the original output order
+    with ThreadPoolExecutor(max_workers=min(8, len(tasks))) as executor:
+        results = list(executor.map(partial(fetch_image, upload_prefix=upload_prefix), tasks))
     
-    return images
+    return [image for image in results if image is not None]
 
 def handler(event):
     """
     Main handler function for RunPod serverless endpoint with ComfyUI integration.
+    Yields each image as soon as it is available, followed by a final status message.
     """
     request_id = event.get('id', 'unknown')
-    logger.info(f"Processing request {request_id}")
+    logger.info("Processing request %s", request_id)
     
     try:
         # Parse input data
         input_data = event.get('input', {})
         
         # Log request details
-        logger.info(f"Request {request_id} - Input keys: {list(input_data.keys())}")
+        logger.info("Request %s - Input keys: %s", request_id, input_data.keys())
         
         # Validate input
         validation_error = validate_input(input_data)
         if validation_error:
-            logger.warning(f"Request {request_id} - Input validation failed: {validation_error}")
-            return {
+            logger.warning("Request %s - Input validation failed: %s", request_id, validation_error)
+            yield {
                 "status": "error",
                 "message": f"Input validation failed: {validation_error}",
                 "request_id": request_id
             }
+            return
         
         # Check if ComfyUI server is accessible
-        try:
-            response = requests.get(f"{COMFYUI_SERVER_URL}/system_stats", timeout=10)
-            if response.status_code != 200:
-                return {
-                    "status": "error",
-                    "message": "ComfyUI server is not accessible",
-                    "request_id": request_id
-                }
-        except requests.exceptions.RequestException:
-            return {
+        health_error = check_comfyui_health()
+        if health_error:
+            yield {
                 "status": "error",
-                "message": "Cannot connect to ComfyUI server",
+                "message": health_error,
                 "request_id": request_id
             }
+            return
         
         # Process workflow or create simple workflow
-        if 'workflow' in input_data:
-            workflow = input_data['workflow']
-            logger.info(f"Request {request_id} - Using custom workflow")
+        key = batch_key(input_data)
+        if key is not None:
+            logger.info("Request %s - Batching simple workflow for prompt: %.50s...", request_id, input_data['prompt'])
+            prompt_id, outputs, batch_index, batch_size = run_batched(key, input_data, request_id)
+            logger.info("Request %s - Completed as item %d of %d in prompt %s", request_id, batch_index + 1, batch_size, prompt_id)
+            node_outputs = split_batch_outputs(outputs, batch_index, batch_size).items()
         else:
-            workflow = create_simple_workflow(input_data)
-            logger.info(f"Request {request_id} - Created simple workflow for prompt: {input_data['prompt'][:50]}...")
-        
-        # Queue the prompt
-        prompt_id = queue_prompt(workflow)
-        logger.info(f"Request {request_id} - Queued prompt with ID: {prompt_id}")
+            if 'workflow' in input_data:
+                workflow = input_data['workflow']
+                logger.info("Request %s - Using custom workflow", request_id)
+            else:
+                workflow = create_simple_workflow(input_data)
+                logger.info("Request %s - Created simple workflow for prompt: %.50s...", request_id, input_data['prompt'])
+            
+            logger.info("Request %s - Waiting for completion...", request_id)
+            prompt_id, node_outputs = run_workflow(workflow, request_id)
         
-        # Wait for completion
-        logger.info(f"Request {request_id} - Waiting for completion...")
-        result = wait_for_completion(prompt_id, timeout=300)
+        # Upload to object storage when configured, unless inline data was requested
+        upload_prefix = None
+        if _S3 is not None and not input_data.get('return_inline'):
+            upload_prefix = f"{prompt_id}/"
         
-        # Extract images from output
-        outputs = result.get('outputs', {})
-        images = extract_images_from_output(outputs)
+        # Extract and send images node by node as outputs become available
+        output_nodes = []
+        images_count = 0
+        for node_id, node_output in node_outputs:
+            output_nodes.append(node_id)
+            for image in extract_images_from_output({node_id: node_output}, upload_prefix):
+                images_count += 1
+                # 'kind' marks stream chunks; 'type' is ComfyUI's output/temp folder
+                yield {"kind": "image", **image}
         
-        logger.info(f"Request {request_id} - Completed successfully - generated {len(images)} images")
+        logger.info("Request %s - Completed successfully - generated %d images", request_id, images_count)
         
-        return {
+        yield {
             "status": "success",
             "prompt_id": prompt_id,
-            "images": images,
-            "outputs": list(outputs.keys()),
+            "images_count": images_count,
+            "outputs": output_nodes,
             "request_id": request_id
         }
             
     except TimeoutError as e:
-        logger.error(f"Request {request_id} - Timeout: {str(e)}")
-        return {
+        logger.error("Request %s - Timeout: %s", request_id, e)
+        yield {
             "status": "error",
             "message": f"Generation timed out: {str(e)}",
             "request_id": request_id
         }
     except Exception as e:
-        logger.error(f"Request {request_id} - Error: {str(e)}", exc_info=True)
-        return {
+        logger.error("Request %s - Error: %s", request_id, e, exc_info=True)
+        yield {
             "status": "error",
             "message": f"Internal server error: {str(e)}",
             "request_id": request_id
         }
 
+async def async_handler(event):
+    """
+    Async entry point so RunPod can run several jobs concurrently.
+    The blocking handler generator is advanced in a worker thread per job.
+    """
+    global _jobs_in_flight
+    _jobs_in_flight += 1
+    try:
+        results = handler(event)
+        step = None
+        try:
+            while True:
+                step = _HANDLER_EXECUTOR.submit(next, results, None)
+                result = await asyncio.wrap_future(step)
+                if result is None:
+                    break
+                yield result
+        finally:
+            if step is None or step.done():
+                await asyncio.wrap_future(_HANDLER_EXECUTOR.submit(results.close))
+            else:
+                # Cancelled while a worker is still inside the generator (e.g. blocked
+                # in ws.recv()); closing it now would raise "generator already
+                # executing", so close it from that worker once the step returns
+                step.add_done_callback(lambda _: results.close())
+    finally:
+        # Batching reads this count, so it must drop even if cleanup fails
+        _jobs_in_flight -= 1
+
+def concurrency_modifier(current_concurrency: int) -> int:
+    """Tell RunPod how many jobs to hand this worker at once"""
+    return MAX_CONCURRENCY
+
 # Start the RunPod serverless handler
 if __name__ == "__main__":
-    runpod.serverless.start({"handler": handler})
+    runpod.serverless.start({
+        "handler": async_handler,
+        "concurrency_modifier": concurrency_modifier,
+        # Collect streamed chunks into the /run and /runsync output as a list
+        "return_aggregate_stream": True
+    })